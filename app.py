@@ -1,55 +1,151 @@
 from flask import Flask, request
+from twilio.rest import Client
 from twilio.twiml.messaging_response import MessagingResponse
-import requests
+import cachetools
+import httpx
+import orjson
+import simdjson
+import collections
+import concurrent.futures
 import datetime
+import logging
+import math
 import os
 import threading
+import time
+import types
 
 app = Flask(__name__)
 
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'))
+LOG = logging.getLogger(__name__)
+
 STORMGLASS_API_KEY = os.getenv('STORMGLASS_API_KEY')
 
-SPOTS = {
+# Cliente REST do Twilio para responder fora do webhook. Sem as credenciais
+# configuradas o bot mantém o comportamento síncrono antigo.
+TWILIO_ACCOUNT_SID = os.getenv('TWILIO_ACCOUNT_SID')
+TWILIO_AUTH_TOKEN = os.getenv('TWILIO_AUTH_TOKEN')
+TWILIO_CLIENT = (
+    Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN
+    else None
+)
+
+# Cliente compartilhado com keep-alive e HTTP/2: os refreshes do warmer e as
+# consultas paralelas às 4 praias viram streams multiplexados numa única
+# conexão com a Stormglass, em vez de 4 conexões TCP separadas.
+CLIENT = httpx.Client(
+    # Sem a chave configurada não manda header nenhum (None aqui quebraria o
+    # httpx no import); a Stormglass responde 403 e o bot degrada para o
+    # fallback Open-Meteo, como no comportamento original.
+    headers={'Authorization': STORMGLASS_API_KEY} if STORMGLASS_API_KEY else None,
+    timeout=httpx.Timeout(connect=3.05, read=10, write=10, pool=10),
+    transport=httpx.HTTPTransport(
+        http2=True,
+        retries=2,
+        limits=httpx.Limits(max_keepalive_connections=8, max_connections=16),
+    ),
+)
+
+SPOTS = types.MappingProxyType({
     'balneario': (-26.9931, -48.6350),
     'guarda':    (-27.9496, -48.6189),
     'itajai':    (-26.9101, -48.6536),
     'floripa':   (-27.5954, -48.5480)
+})
+
+# Só fontes gratuitas (tupla: iteração mais barata e imutável)
+SOURCES_PRIORITY = ('noaa', 'sg', 'meteo')
+
+# Parte fixa da URL da Stormglass pré-montada por praia; por requisição
+# só start/end variam.
+STORMGLASS_URL_PREFIX = {
+    spot: (
+        f'https://api.stormglass.io/v2/weather/point'
+        f'?lat={lat}&lng={lng}'
+        f'&params=waveHeight,windSpeed,windDirection,wavePeriod'
+    )
+    for spot, (lat, lng) in SPOTS.items()
 }
 
-# Só fontes gratuitas
-SOURCES_PRIORITY = ['noaa', 'sg', 'meteo']
+CACHE_TTL_MINUTES = 30
 
-CACHE = {}
+# TTLCache cuida de validade e de limite de tamanho: entradas expiradas
+# são descartadas no acesso e o dict não cresce sem limite.
+CACHE = cachetools.TTLCache(maxsize=256, ttl=CACHE_TTL_MINUTES * 60)
 CACHE_LOCK = threading.Lock()
-CACHE_TTL_MINUTES = 30
+
+# Pool de threads para disparar Stormglass e Open-Meteo em paralelo:
+# no pior caso a espera vira max(t_stormglass, t_openmeteo) em vez da soma.
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+# Pool separado para as respostas assíncronas do webhook: _compute_and_send
+# bloqueia esperando os futures de fetch do EXECUTOR, então num pool só uma
+# rajada de cache misses ocuparia todos os workers com tarefas que apenas
+# esperam as consultas enfileiradas atrás delas.
+DISPATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8)
+
+# Orçamento do webhook do Twilio é de 15 s; deixa margem para o TwiML.
+FETCH_TIMEOUT_SECONDS = 12
+
+# Templates das mensagens compilados uma vez; .format() só preenche os
+# campos em vez de remontar a string por partes a cada previsão.
+FORECAST_TEMPLATE = (
+    "🌊 Previsão para {spot} (próximas 24 h):\n"
+    "• Ondas: {wh:.1f} m / {wp:.1f} s\n"
+    "• Vento: {ws:.1f} m/s ({wd})\n"
+)
+FALLBACK_TEMPLATE = (
+    "🌊 Fallback Open-Meteo (24 h):\n"
+    "• Altura média das ondas: {wh:.1f} m\n"
+    "• Vento médio: {ws:.1f} m/s\n"
+    "ℹ️ Dados via Open-Meteo."
+)
+
+# Parser simdjson reutilizado (reaproveitar o buffer interno é bem mais
+# rápido que criar um parser por resposta). Um por thread, porque o
+# documento retornado é invalidado pelo próximo parse do mesmo parser.
+_PARSER_LOCAL = threading.local()
+
+def _simdjson_parser():
+    parser = getattr(_PARSER_LOCAL, 'parser', None)
+    if parser is None:
+        parser = _PARSER_LOCAL.parser = simdjson.Parser()
+    return parser
+
+def _get_param(hour_data, p, _prio=SOURCES_PRIORITY):
+    # Hoisted para fora do loop de horas: compilada uma vez, com a ordem de
+    # fontes congelada no default. Proxies do simdjson não têm .get(), daí
+    # a indexação direta com KeyError.
+    try:
+        by_source = hour_data[p]
+    except KeyError:
+        return None
+    for src in _prio:
+        try:
+            val = by_source[src]
+        except KeyError:
+            continue
+        if val is not None:
+            return val
+    return None
 
 def degrees_to_direction(degrees):
     dirs = ['Norte', 'Nordeste', 'Leste', 'Sudeste', 'Sul', 'Sudoeste', 'Oeste', 'Noroeste']
     ix = int((degrees + 22.5) / 45) % 8
     return dirs[ix]
 
-def is_cache_valid(cache_time_str):
-    try:
-        cache_time_dt = datetime.datetime.strptime(cache_time_str, '%Y-%m-%dT%H').replace(tzinfo=datetime.timezone.utc)
-        return (datetime.datetime.now(datetime.timezone.utc) - cache_time_dt).total_seconds() < CACHE_TTL_MINUTES * 60
-    except:
-        return False
-
 def get_cached_forecast(spot):
-    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
-    key = (spot, now.strftime('%Y-%m-%dT%H'))
     with CACHE_LOCK:
-        entry = CACHE.get(key)
-        if entry and is_cache_valid(key[1]):
-            print(f"[Cache] Retornando previsão em cache para {spot}")
-            return entry
-    return None
+        entry = CACHE.get(spot)
+    if entry:
+        LOG.info("[Cache] Retornando previsão em cache para %s", spot)
+    return entry
 
 def set_cached_forecast(spot, forecast_msg):
-    now = datetime.datetime.now(datetime.timezone.utc).replace(minute=0, second=0, microsecond=0)
-    key = (spot, now.strftime('%Y-%m-%dT%H'))
     with CACHE_LOCK:
-        CACHE[key] = forecast_msg
+        CACHE[spot] = forecast_msg
 
 def fallback_open_meteo(lat, lng):
     """
@@ -62,15 +158,16 @@ def fallback_open_meteo(lat, lng):
         f"&timezone=UTC&forecast_days=1"
     )
     try:
-        r = requests.get(url, timeout=10)
-    except:
+        r = CLIENT.get(url)
+    except httpx.HTTPError:
         # Se falhar rede/time-out
         return "Fallback: falha ao checar Open-Meteo. Tente novamente mais tarde."
 
     if r.status_code != 200:
         return "Fallback: Open-Meteo indisponível agora. Tente novamente mais tarde."
 
-    hourly = r.json().get('hourly', {})
+    # orjson.loads aceita bytes direto, pulando o decode utf-8 do .text
+    hourly = orjson.loads(r.content).get('hourly', {})
     waves = hourly.get('wave_height', [])
     winds = hourly.get('wind_speed', [])
 
@@ -79,138 +176,220 @@ def fallback_open_meteo(lat, lng):
 
     avg_wave = sum(waves) / len(waves)
     avg_wind = sum(winds) / len(winds)
-    return (
-        f"🌊 Fallback Open-Meteo (24 h):\n"
-        f"• Altura média das ondas: {avg_wave:.1f} m\n"
-        f"• Vento médio: {avg_wind:.1f} m/s\n"
-        f"ℹ️ Dados via Open-Meteo."
-    )
+    return FALLBACK_TEMPLATE.format(wh=avg_wave, ws=avg_wind)
 
-def get_surf_forecast(spot_name):
-    if spot_name not in SPOTS:
-        return "Praia não encontrada. Exemplo: surf balneario"
-
-    # 1) Verifica cache
-    cached = get_cached_forecast(spot_name)
-    if cached:
-        return cached
-
-    LATITUDE, LONGITUDE = SPOTS[spot_name]
-    now = datetime.datetime.now(datetime.timezone.utc)
-    start = now.replace(microsecond=0).isoformat().replace("+00:00", "Z")
+def _fetch_stormglass(spot_name):
+    """
+    Consulta a Stormglass e monta a mensagem de previsão.
+    Retorna None quando a resposta não serve (erro, 402, sem horas válidas),
+    sinalizando que o resultado do Open-Meteo deve ser usado.
+    """
+    # Uma única leitura de relógio por consulta; todo o resto deriva dela.
+    now = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+    start = now.isoformat().replace("+00:00", "Z")
     end_time = now + datetime.timedelta(hours=24)
-    end = end_time.replace(microsecond=0).isoformat().replace("+00:00", "Z")
+    end = end_time.isoformat().replace("+00:00", "Z")
 
-    url = (
-        f'https://api.stormglass.io/v2/weather/point'
-        f'?lat={LATITUDE}&lng={LONGITUDE}'
-        f'&params=waveHeight,windSpeed,windDirection,wavePeriod'
-        f'&start={start}&end={end}'
-    )
-    headers = {'Authorization': STORMGLASS_API_KEY}
+    url = f'{STORMGLASS_URL_PREFIX[spot_name]}&start={start}&end={end}'
     try:
-        response = requests.get(url, headers=headers, timeout=10)
-    except:
+        response = CLIENT.get(url)
+    except httpx.HTTPError:
         # Falha de rede ou timeout
-        return fallback_open_meteo(LATITUDE, LONGITUDE)
+        return None
 
-    print(f"[API] Consulta Stormglass ({spot_name}): {response.status_code} | URL: {url}")
+    LOG.info("[API] Consulta Stormglass (%s): %s | URL: %s", spot_name, response.status_code, url)
 
     if response.status_code == 402:
         # Agora cai direto no fallback Open-Meteo
-        print(f"[Stormglass] 402 para {spot_name}, ativando fallback Open-Meteo.")
-        return fallback_open_meteo(LATITUDE, LONGITUDE)
+        LOG.info("[Stormglass] 402 para %s, ativando fallback Open-Meteo.", spot_name)
+        return None
 
     if response.status_code != 200:
-        return "Não consegui obter a previsão no momento 😞"
+        return None
 
-    data = response.json()
-    hours = data.get('hours', [])
+    # Parse preguiçoso: só os campos realmente lidos viram objetos Python,
+    # o resto do payload (demais fontes/parâmetros) nunca é materializado.
+    try:
+        doc = _simdjson_parser().parse(response.content)
+        hours = doc['hours']
+    except (ValueError, KeyError):
+        hours = ()
 
     if not hours:
         # Mesmo que seja 200, mas sem horas válidas
-        print(f"[Stormglass] Sem dados válidos para {spot_name}, fallback Open-Meteo.")
-        return fallback_open_meteo(LATITUDE, LONGITUDE)
-
-    # 2) Organiza dados do dia atual
-    forecast_per_day = {}
+        LOG.info("[Stormglass] Sem dados válidos para %s, fallback Open-Meteo.", spot_name)
+        return None
+
+    # 2) Agrega em uma passada: somas acumuladas por dia, sem montar listas
+    # de dicts intermediárias por hora. A direção do vento acumula sen/cos
+    # (média circular): média aritmética de graus erra na descontinuidade
+    # 0/360 — mean(350°, 10°) daria 180° em vez de 0°.
+    # Campos: wh, wp, ws, sen(wd), cos(wd), n
+    sums_per_day = collections.defaultdict(lambda: [0.0, 0.0, 0.0, 0.0, 0.0, 0])
     for hour_data in hours:
-        t = hour_data.get('time')
-        if not t:
-            continue
+        # Proxies do simdjson não têm .get(); indexação direta com KeyError.
         try:
-            d = datetime.datetime.fromisoformat(t.replace("Z", "+00:00"))
-        except:
+            t = hour_data['time']
+        except KeyError:
             continue
-        dia = d.date()
-        if dia not in forecast_per_day:
-            forecast_per_day[dia] = []
-
-        def get_param(p):
-            for src in SOURCES_PRIORITY:
-                val = hour_data.get(p, {}).get(src)
-                if val is not None:
-                    return val
-            return None
-
-        wh = get_param('waveHeight')
-        wp = get_param('wavePeriod')
-        ws = get_param('windSpeed')
-        wd = get_param('windDirection')
+        if not t:
+            continue
+        # Timestamp da Stormglass é sempre YYYY-MM-DDTHH:MM:SSZ e só a data
+        # interessa: fatiar os 10 primeiros chars evita construir um
+        # datetime com timezone por hora do payload.
+        dia = t[:10]
+
+        wh = _get_param(hour_data, 'waveHeight')
+        wp = _get_param(hour_data, 'wavePeriod')
+        ws = _get_param(hour_data, 'windSpeed')
+        wd = _get_param(hour_data, 'windDirection')
 
         if None not in (wh, wp, ws, wd):
-            forecast_per_day[dia].append({
-                'wave_height': wh,
-                'wave_period': wp,
-                'wind_speed': ws,
-                'wind_dir': wd
-            })
+            s = sums_per_day[dia]
+            s[0] += wh
+            s[1] += wp
+            s[2] += ws
+            wd_rad = math.radians(wd)
+            s[3] += math.sin(wd_rad)
+            s[4] += math.cos(wd_rad)
+            s[5] += 1
 
     # 3) Monta mensagem para as próximas 24 h (dia atual)
-    today = now.date()
-    measures = forecast_per_day.get(today, [])
-    if not measures:
+    today = now.date().isoformat()
+    s = sums_per_day.get(today)
+    if not s:
         # Caso sem dados válidos, fallback
-        print(f"[Stormglass] Sem dados hoje para {spot_name}, fallback Open-Meteo.")
-        return fallback_open_meteo(LATITUDE, LONGITUDE)
-
-    avg_wh = sum(m['wave_height'] for m in measures) / len(measures)
-    avg_wp = sum(m['wave_period'] for m in measures) / len(measures)
-    avg_ws = sum(m['wind_speed'] for m in measures) / len(measures)
-    avg_wd = sum(m['wind_dir'] for m in measures) / len(measures)
+        LOG.info("[Stormglass] Sem dados hoje para %s, fallback Open-Meteo.", spot_name)
+        return None
+
+    n = s[5]
+    avg_wh = s[0] / n
+    avg_wp = s[1] / n
+    avg_ws = s[2] / n
+    avg_wd = math.degrees(math.atan2(s[3], s[4])) % 360
     dir_str = degrees_to_direction(avg_wd)
 
-    forecast_msg = (
-        f"🌊 Previsão para {spot_name.title()} (próximas 24 h):\n"
-        f"• Ondas: {avg_wh:.1f} m / {avg_wp:.1f} s\n"
-        f"• Vento: {avg_ws:.1f} m/s ({dir_str})\n"
+    return FORECAST_TEMPLATE.format(
+        spot=spot_name.title(), wh=avg_wh, wp=avg_wp, ws=avg_ws, wd=dir_str
     )
 
-    # 4) Guarda no cache e retorna
-    set_cached_forecast(spot_name, forecast_msg)
-    return forecast_msg
+def get_surf_forecast(spot_name):
+    if spot_name not in SPOTS:
+        return "Praia não encontrada. Exemplo: surf balneario"
+
+    # 1) Verifica cache
+    cached = get_cached_forecast(spot_name)
+    if cached:
+        return cached
+
+    LATITUDE, LONGITUDE = SPOTS[spot_name]
+
+    # 2) Dispara as duas consultas em paralelo; o fallback já fica pronto
+    # caso a Stormglass falhe, sem somar as duas esperas.
+    f_sg = EXECUTOR.submit(_fetch_stormglass, spot_name)
+    f_om = EXECUTOR.submit(fallback_open_meteo, LATITUDE, LONGITUDE)
+
+    try:
+        forecast_msg = f_sg.result(timeout=FETCH_TIMEOUT_SECONDS)
+    except concurrent.futures.TimeoutError:
+        forecast_msg = None
+
+    if forecast_msg is not None:
+        # 3) Stormglass respondeu: guarda no cache e retorna
+        f_om.cancel()
+        set_cached_forecast(spot_name, forecast_msg)
+        return forecast_msg
+
+    try:
+        # Já esperamos a Stormglass; o Open-Meteo rodou em paralelo e deve
+        # estar pronto — espera curta só por garantia.
+        return f_om.result(timeout=3)
+    except concurrent.futures.TimeoutError:
+        return "Não consegui obter a previsão no momento 😞"
+
+def _warm_spot(spot):
+    # Vai direto na Stormglass (sem checar o cache) para renovar a entrada
+    # mesmo que a atual ainda esteja válida.
+    forecast_msg = _fetch_stormglass(spot)
+    if forecast_msg is not None:
+        set_cached_forecast(spot, forecast_msg)
+
+def _cache_warmer_loop():
+    """
+    Pré-aquece as 4 praias em paralelo um pouco antes do TTL vencer, para
+    que os webhooks virem praticamente só cache hit.
+    """
+    while True:
+        LOG.info("[Warmer] Atualizando previsões de %d praias", len(SPOTS))
+        for spot in SPOTS:
+            EXECUTOR.submit(_warm_spot, spot)
+        time.sleep(CACHE_TTL_MINUTES * 60 - 60)
+
+threading.Thread(target=_cache_warmer_loop, name='cache-warmer', daemon=True).start()
+
+def _compute_and_send(spot, to_number, from_number):
+    """
+    Roda fora do webhook: calcula a previsão e envia via API REST do Twilio.
+    """
+    forecast = get_surf_forecast(spot)
+    LOG.info("[Bot] Resposta assíncrona para %s: %s", to_number, forecast)
+    try:
+        TWILIO_CLIENT.messages.create(to=to_number, from_=from_number, body=forecast)
+    except Exception as e:
+        LOG.warning("[Twilio] Falha ao enviar resposta assíncrona: %s", e)
+
+def _static_twiml(body):
+    resp = MessagingResponse()
+    resp.message().body(body)
+    return str(resp)
+
+# Respostas que nunca mudam, serializadas uma vez no import: os caminhos de
+# ajuda/erro/ack devolvem a string pronta sem montar MessagingResponse.
+TWIML_HELP = _static_twiml("Envie no formato: surf [praia]. Exemplo: surf itajai")
+TWIML_MISSING_SPOT = _static_twiml("Informe a praia. Exemplo: surf balneario")
+TWIML_ACK = _static_twiml("Consultando previsão... ⏳")
+TWIML_HEADERS = {'Content-Type': 'application/xml'}
 
 @app.route("/whatsapp", methods=['POST'])
 def whatsapp_reply():
-    incoming_msg = request.form.get('Body', '').lower().strip()
-    resp = MessagingResponse()
-    msg = resp.message()
-
-    if incoming_msg.startswith('surf'):
-        partes = incoming_msg.split()
-        if len(partes) >= 2:
-            spot = partes[1]
-            forecast = get_surf_forecast(spot)
-            print(f"[Bot] Resposta gerada: {forecast}")
-            msg.body(forecast)
-        else:
-            msg.body("Informe a praia. Exemplo: surf balneario")
+    incoming_msg = request.form.get('Body', '').strip()
+
+    # Um único split limitado aos dois primeiros tokens (quebra em qualquer
+    # espaço em branco, como o split() original); só o token inspecionado é
+    # normalizado com casefold
+    partes = incoming_msg.split(None, 2)
+    cmd = partes[0] if partes else ''
+    if cmd.casefold() != 'surf':
+        return TWIML_HELP, 200, TWIML_HEADERS
+
+    spot = partes[1].casefold() if len(partes) > 1 else ''
+    if not spot:
+        return TWIML_MISSING_SPOT, 200, TWIML_HEADERS
+
+    cached = get_cached_forecast(spot) if spot in SPOTS else None
+    if cached:
+        # Cache hit: responde na hora pelo próprio TwiML
+        forecast = cached
+    elif TWILIO_CLIENT is not None and spot in SPOTS:
+        # Cache miss: confirma já e deixa a consulta para o pool,
+        # tirando a espera da Stormglass do caminho do webhook
+        DISPATCH_EXECUTOR.submit(
+            _compute_and_send,
+            spot,
+            request.form.get('From', ''),
+            request.form.get('To', '')
+        )
+        return TWIML_ACK, 200, TWIML_HEADERS
     else:
-        msg.body("Envie no formato: surf [praia]. Exemplo: surf itajai")
+        forecast = get_surf_forecast(spot)
+        LOG.info("[Bot] Resposta gerada: %s", forecast)
 
+    resp = MessagingResponse()
+    resp.message().body(forecast)
     twiml = str(resp)
-    print(f"[TwiML] {twiml}")
+    LOG.debug("[TwiML] %s", twiml)
     return twiml
 
 if __name__ == "__main__":
-    app.run(debug=True)
+    # Só para teste local; em produção use o gunicorn (ver Procfile/wsgi.py).
+    app.run()
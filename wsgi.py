@@ -0,0 +1,6 @@
+# O monkey-patch precisa vir antes de qualquer import que toque em sockets
+# (requests, urllib3), senão as chamadas à Stormglass continuam bloqueantes.
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402